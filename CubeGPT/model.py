@@ -345,7 +345,8 @@ class GPT(nn.Module):
         # new PyTorch nightly has a new 'fused' option for AdamW that is much faster
         use_fused = (device_type == 'cuda') and ('fused' in inspect.signature(torch.optim.AdamW).parameters)
         print(f"using fused AdamW: {use_fused}")
-        extra_args = dict(fused=True) if use_fused else dict()
+        # otherwise fall back to the multi-tensor (foreach) kernels, which still batch the update over all params of a group
+        extra_args = dict(fused=True) if use_fused else dict(foreach=True)
         optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=betas, **extra_args)
 
         return optimizer
@@ -0,0 +1,640 @@
+"""
+Training loop shared by CubeGPT/train_cube.py and FifteenPuzzleGPT/train_15_puzzle.py.
+The two only differ in their model (each has its own model.py), the dtype of their ".bin" files and which window of a
+row they train on, so those are passed in to <train> and everything else lives here.
+"""
+import os
+import time
+import functools
+import concurrent.futures
+import math
+import mmap
+import pickle
+import queue
+import threading
+import numpy as np
+import torch
+import logging  # Better than printing because it is saved in a log file as well
+
+from omegaconf import OmegaConf
+try:
+    import numba # Optional, <gather_windows> falls back to numpy without it.
+except ImportError:
+    numba = None
+
+# a TORCHINDUCTOR_CACHE_DIR set by the user wins over the per run one of <train>. Read at import, before inductor may
+# have filled in its own default
+_user_inductor_cache_dir = os.environ.get('TORCHINDUCTOR_CACHE_DIR')
+
+
+def create_model_from_scratch(GPTConfig, GPT, model_args, meta_vocab_size):
+    """Creates a new model to train"""
+    logging.info("Initializing a new model from scratch")
+    # determine the vocab size we'll use for from-scratch training
+    assert(meta_vocab_size is not None)
+    model_args['vocab_size'] = meta_vocab_size
+    gptconf = GPTConfig(**model_args)
+    return GPT(gptconf)
+
+
+def load_model(GPTConfig, GPT, model_args, config):
+    """Loads an old model"""
+    logging.info(f"Resuming training from {config['out_dir']}")
+    # resume training from a checkpoint.
+    ckpt_path = os.path.join(config['out_dir'], 'ckpt.pt')
+    # map_location puts the tensors (the optimizer state too) onto the training device. On a GPU that still copies every
+    # tensor up front, mmap=True only saves reading the file into an intermediate host copy first (on the CPU the
+    # tensors stay lazily mapped). weights_only=True only unpickles tensors and plain containers, which is why the
+    # config is saved as a plain dict.
+    try:
+        checkpoint = torch.load(ckpt_path, map_location=config['device'], mmap=True, weights_only=True)
+    except pickle.UnpicklingError:
+        # older checkpoints store the hydra DictConfig itself, which only a full unpickle can restore
+        print(f"{ckpt_path} is an older checkpoint, loading it with weights_only=False")
+        checkpoint = torch.load(ckpt_path, map_location=config['device'], mmap=True, weights_only=False)
+    checkpoint_model_args = checkpoint['model_args']
+    # force these config attributes to be equal otherwise we can't even resume training
+    # the rest of the attributes (e.g. dropout) can stay as desired from command line
+    for k in ['n_layer', 'n_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
+        model_args[k] = checkpoint_model_args[k]
+    # create the model
+    gptconf = GPTConfig(**model_args)
+    model = GPT(gptconf)
+    # fix the keys of the state dictionary :(
+    # honestly no idea how checkpoints sometimes get this prefix, have to debug more
+    state_dict = {k.removeprefix('_orig_mod.'): v for k, v in checkpoint['model'].items()}
+    # assign=True takes the loaded tensors as they are instead of copying them into the freshly initialized ones
+    model.load_state_dict(state_dict, assign=True)
+    # assigning replaced the two tied weights by separate parameters, so tie them again
+    model.transformer.wte.weight = model.lm_head.weight
+
+    iter_num = checkpoint['iter_num']
+    best_val_loss = checkpoint['best_val_loss']
+
+    return model, checkpoint, iter_num, best_val_loss
+
+
+class RowPrefetcher:
+    """Streams a ".bin" file of fixed-length rows into an in-RAM ring from a background thread.
+    Random-access reads on a memmap fault in pages all over the file, so instead the file is read sequentially in large
+    chunks of whole rows (chunk order shuffled every epoch) and batches are sampled from the chunks currently in the ring.
+    If the whole file fits in the ring it is read exactly once and the thread exits. Otherwise one chunk is swapped in
+    per <chunk_rows> sampled rows, so the file is read about as fast as it is consumed and not as fast as the disk allows.
+    """
+    def __init__(self, path, dtype, num_tokens_per_row, chunk_mib, num_chunks, seed):
+        self.path = path
+        self.row_bytes = np.dtype(dtype).itemsize * num_tokens_per_row
+        self.num_rows = os.path.getsize(path) // self.row_bytes
+        self.chunk_rows = max(1, min(self.num_rows, chunk_mib * 2**20 // self.row_bytes))
+        self.num_file_chunks = -(-self.num_rows // self.chunk_rows)
+        self.streaming = self.num_file_chunks > num_chunks
+        self.num_live = min(num_chunks, self.num_file_chunks) # Number of chunks batches are sampled from.
+        num_slots = self.num_live + (2 if self.streaming else 0) # While streaming, up to two more are loading or ready.
+        self.ring = np.empty((num_slots, self.chunk_rows, num_tokens_per_row), dtype=dtype)
+        self.rows = self.ring.reshape(-1, num_tokens_per_row) # [num_slots * chunk_rows, num_tokens_per_row] view.
+        self.slot_rows = np.zeros(num_slots, dtype=np.int64) # Valid rows per slot, the last chunk of the file may be short.
+        self.live = [] # Slots batches are sampled from, the oldest first.
+        self.drawn = 0 # Rows sampled since the last chunk swap.
+        # Slots are handed between the threads through these queues, so a slot is never read and written at the same time.
+        self.free = queue.Queue()
+        self.ready = queue.Queue(maxsize=2)
+        for slot in range(num_slots):
+            self.free.put(slot)
+        self.seed = seed
+        threading.Thread(target=self._stream, daemon=True).start()
+        while len(self.live) < self.num_live:
+            self._add(*self.ready.get())
+
+    def _stream(self):
+        """Body of the background thread: reads chunks into free slots and hands them over as ready."""
+        rng = np.random.default_rng(self.seed)
+        with open(self.path, 'rb') as f:
+            while True:
+                for chunk in rng.permutation(self.num_file_chunks): # Epoch-shuffled chunk order.
+                    slot = self.free.get()
+                    if slot is None: # see <close>
+                        return
+                    n = min(self.chunk_rows, self.num_rows - chunk * self.chunk_rows)
+                    f.seek(int(chunk) * self.chunk_rows * self.row_bytes)
+                    f.readinto(self.ring[slot, :n].reshape(-1).view(np.uint8)) # Straight into the ring, no allocation.
+                    self.ready.put((slot, n))
+                if not self.streaming:
+                    return
+
+    def close(self):
+        """Lets the background thread exit, so a finished <train> does not keep it and the ring alive."""
+        self.free.put(None)
+
+    def _add(self, slot, n):
+        self.slot_rows[slot] = n
+        self.live.append(slot)
+
+    def sample_index(self, batch_size):
+        """Returns <batch_size> indices into <self.rows>, uniformly over all rows in the live chunks."""
+        if self.streaming and self.drawn >= self.chunk_rows:
+            # a chunk's worth of rows was sampled, swap in one freshly read chunk (if ready) for the oldest live one
+            try:
+                self._add(*self.ready.get_nowait())
+            except queue.Empty:
+                pass
+            else:
+                oldest = self.live.pop(0)
+                self.slot_rows[oldest] = 0
+                self.free.put(oldest)
+                self.drawn = 0
+        self.drawn += batch_size
+        live = np.array(self.live)
+        counts = self.slot_rows[live]
+        ends = np.cumsum(counts)
+        r = torch.randint(int(ends[-1]), (batch_size,)).numpy()
+        pos = np.searchsorted(ends, r, side='right') # Which live chunk each sampled row falls in.
+        return live[pos] * self.chunk_rows + r - (ends[pos] - counts[pos])
+
+
+# path -> (key, value) of the latest version of each file, see <open_rows> and <load_meta_vocab_size>
+_open_rows_cache = {}
+_meta_vocab_size_cache = {}
+
+
+def open_rows(path, dtype, num_tokens_per_row):
+    """Opens a ".bin" file of fixed-length rows as a read-only [num_rows, num_tokens_per_row] memmap.
+    The mapping is cached, so repeated <train> calls in one process (e.g. from Agent.py) reuse it until the file changes.
+    Only the latest version of each file is kept, so a regenerated file releases the mapping of the old one.
+    """
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size, np.dtype(dtype), num_tokens_per_row)
+    cached = _open_rows_cache.get(path)
+    if cached is None or cached[0] != key:
+        _open_rows_cache[path] = cached = (key, _open_rows(path, st.st_size, dtype, num_tokens_per_row))
+    return cached[1]
+
+
+def _open_rows(path, size, dtype, num_tokens_per_row):
+    """<open_rows> without the cache."""
+    num_rows = size // (np.dtype(dtype).itemsize * num_tokens_per_row)
+    rows = np.memmap(path, dtype=dtype, mode='r', shape=(num_rows, num_tokens_per_row)) # Ted: Allow to read large file without needing to fit entire file into physical memory (i.e. RAM).
+    # rows are sampled at random, so reading ahead around each page fault only wastes I/O. Instead ask the kernel
+    # to pull the whole file into the page cache once, up front. Both hints are Linux/POSIX only.
+    if hasattr(mmap, 'MADV_RANDOM') and rows._mmap is not None:
+        rows._mmap.madvise(mmap.MADV_RANDOM)
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    return rows
+
+
+def load_meta_vocab_size(data_dir):
+    """Returns the vocab_size stored in <data_dir>/meta.pkl, or None if there is no such file. Cached like <open_rows>."""
+    meta_path = os.path.join(data_dir, 'meta.pkl')
+    if not os.path.exists(meta_path):
+        return None
+    key = os.stat(meta_path).st_mtime_ns
+    cached = _meta_vocab_size_cache.get(meta_path)
+    if cached is None or cached[0] != key:
+        _meta_vocab_size_cache[meta_path] = cached = (key, _load_meta_vocab_size(meta_path))
+    return cached[1]
+
+
+def _load_meta_vocab_size(meta_path):
+    with open(meta_path, 'rb') as f:
+        meta = pickle.load(f)
+    meta_vocab_size = meta['vocab_size']
+    print(f"found vocab_size = {meta_vocab_size} (inside {meta_path})")
+    return meta_vocab_size
+
+
+def gather_windows(rows, ix, start, stop, out):
+    """Writes the row windows rows[ix, start:stop] into the [len(ix), stop - start] array <out>, casting to its dtype.
+    Replaced by the compiled loop below if numba is installed.
+    """
+    out[:] = rows[ix, start:stop] # The fancy index builds a temporary copy first.
+
+
+if numba is not None:
+    @numba.njit(cache=True, nogil=True) # nogil, so the prefetch thread keeps reading meanwhile.
+    def gather_windows(rows, ix, start, stop, out):
+        # copies straight from the rows into <out>, without the temporary or any Python per batch
+        for i in range(ix.shape[0]):
+            row = rows[ix[i]]
+            for t in range(stop - start):
+                out[i, t] = row[start + t]
+
+
+class BatchBuffers:
+    """Persistent pinned host buffers and matching device buffers that <get_batch> copies batches through.
+    Three slots are used in turn: the next batch is filled into one slot on the host and copied on a side CUDA stream
+    while the compute stream may still be reading the batches in the other two. Three, because the training loop
+    fetches the next batch between the forward and the backward of the current one, so a batch is last read by work
+    queued before the fetch after next. With only two slots the copy would have to wait for the forward just queued.
+    With a <seq_len>, x and y are always [batch_size, seq_len] and shorter windows are right-padded (see <get_batch>).
+    Without, they are as long as the window. The buffers are sized for windows of up to <max_seq_len> + 1 tokens.
+    Tokens stay in the narrow <token_dtype> in pinned memory and across the copy, and the window is sent once for both
+    x and y. They are only split and widened to the int64 the embedding and cross_entropy take on the device.
+    """
+    def __init__(self, device, batch_size, max_seq_len, token_dtype, seq_len=None):
+        numel = batch_size * max_seq_len
+        self.max_seq_len = max_seq_len
+        self.seq_len = seq_len
+        self.pin = [torch.empty(numel + batch_size, dtype=token_dtype, pin_memory=True) for _ in range(3)] # Windows are one token longer than x and y.
+        self.narrow = [torch.empty(numel + batch_size, dtype=token_dtype, device=device) for _ in range(3)]
+        self.x_dev = [torch.empty(numel, dtype=torch.int64, device=device) for _ in range(3)]
+        self.y_dev = [torch.empty(numel, dtype=torch.int64, device=device) for _ in range(3)]
+        self.device = device
+        self.copy_stream = torch.cuda.Stream(device)
+        self.copied = [torch.cuda.Event() for _ in range(3)] # Marks the end of each slot's host to device copy.
+        self.consumed = [torch.cuda.Event() for _ in range(3)] # Marks the end of the compute work reading each slot.
+        self.slot = 0
+
+    def load(self, rows, ix, window):
+        """Gathers the windows rows[ix, window] (the slice <window> has length up to max_seq_len + 1) into the next slot
+        and returns its device tensors x, y. x drops the last token of each window and y its first.
+        """
+        compute_stream = torch.cuda.current_stream(self.device)
+        slot = self.slot
+        self.slot = (slot + 1) % 3
+        # all reads of the batch handed out two calls ago are queued by now, the next call reuses its slot
+        self.consumed[self.slot].record(compute_stream)
+        start, stop, _ = window.indices(rows.shape[1])
+        batch_size, window_len = len(ix), stop - start
+        n = window_len - 1
+        out_len = n if self.seq_len is None else self.seq_len
+        assert n <= out_len <= self.max_seq_len, f"row window of {window_len} tokens does not fit seq_len {out_len}"
+        pin = self.pin[slot][:batch_size * window_len].view(batch_size, window_len)
+        narrow = self.narrow[slot][:batch_size * window_len].view(batch_size, window_len)
+        x_dev = self.x_dev[slot][:batch_size * out_len].view(batch_size, out_len)
+        y_dev = self.y_dev[slot][:batch_size * out_len].view(batch_size, out_len)
+        # the pinned slot may still be the source of the copy issued three calls ago
+        self.copied[slot].synchronize()
+        gather_windows(rows, ix, start, stop, pin.numpy()) # Straight into pinned memory.
+        # the device slot may still be read by the batch of three calls ago. Only wait for that (recorded in the
+        # previous call), not for everything queued since, so the copy overlaps the forward just launched
+        self.copy_stream.wait_event(self.consumed[slot])
+        with torch.cuda.stream(self.copy_stream):
+            narrow.copy_(pin, non_blocking=True)
+            x_dev[:, :n].copy_(narrow[:, :-1]) # Widened to int64 on the device.
+            y_dev[:, :n].copy_(narrow[:, 1:])
+            if n < out_len:
+                x_dev[:, n:].zero_()
+                y_dev[:, n:].fill_(-1)
+            self.copied[slot].record()
+        compute_stream.wait_event(self.copied[slot]) # Anything queued after this uses the batch only once it landed.
+        return x_dev, y_dev
+
+
+def get_batch(data, device, num_tokens_per_row, batch_size, row_window, seq_len, buffers=None): # Ted: TODO: Now actually consider to pass <config> in <get_batch> and <estimate_loss>.
+    """Get a batch from the inputted data.
+    This is modified to simply take in the array.
+    data: A [num_rows, num_tokens_per_row] array of rows, or a <RowPrefetcher> streaming them.
+    row_window: Called with <num_tokens_per_row>, returns the slice of the rows to train on (the same for the whole batch).
+    seq_len: Length of the returned x and y, or None to return them as long as the window. Shorter windows are
+        right-padded, x with 0 and y with -1 (the ignore_index of the loss), so every batch has the same shape and the
+        compiled model never sees a new one. This relies on the attention mask never letting a real token see the
+        padding after it. Only worth it when compiling, otherwise the padding is just wasted compute.
+    buffers: A <BatchBuffers> to stage the batch through on CUDA. If None, the batch is simply moved to <device>.
+    """
+    # Ted: TODO: Below can be adjusted to learning history rows.
+    # Ted: TODO: <block_size> is then likely to be dynamic and require padding. E.g. initially we need small block_size but later on maybe larger since challenges will get more and more difficult.
+
+    if isinstance(data, RowPrefetcher):
+        rows, ix = data.rows, data.sample_index(batch_size)
+    else:
+        rows, ix = data, torch.randint(len(data), (batch_size,)).numpy() # Ted: Generate a random 1D tensor of size batch_size with value from 0 to <arg_1> so to not overflow. # Should mean indices for rows in training file.
+
+    window = row_window(num_tokens_per_row)
+    if buffers is not None:
+        return buffers.load(rows, ix, window)
+    # Gather all rows with a single fancy index instead of one slice + tensor per sample.
+    # x drops the last token of the window and y its first.
+    buf = rows[ix, window] # Dimension: [batch_size, window_len], window_len <= seq_len + 1.
+    if seq_len is None:
+        x = torch.from_numpy(buf[:, :-1].astype(np.int64)) # Note the minus one is because recall we need to predict last token, so only need up to second last token.
+        y = torch.from_numpy(buf[:, 1:].astype(np.int64))
+        return x.to(device), y.to(device) # Ted: Move a tensor to device.
+    n = buf.shape[1] - 1 # Note the minus one is because recall we need to predict last token, so only need up to second last token.
+    assert n <= seq_len, f"row window of {n + 1} tokens does not fit seq_len {seq_len}"
+    x = torch.zeros((batch_size, seq_len), dtype=torch.int64) # Dimension: [batch_size, seq_len].
+    y = torch.full((batch_size, seq_len), -1, dtype=torch.int64)
+    x.numpy()[:, :n] = buf[:, :-1]
+    y.numpy()[:, :n] = buf[:, 1:]
+    x, y = x.to(device), y.to(device) # Ted: Move a tensor to device.
+    return x, y
+
+
+# helps estimate an arbitrarily accurate loss over either split using many batches
+@torch.no_grad()
+def estimate_loss(model, autocast_ctx, eval_iters, get_batch_fns, device):
+    """get_batch_fns: Maps each split name to a function without arguments returning one (X, Y) batch of it."""
+    out = {}
+    model.eval()
+    for split, get_split_batch in get_batch_fns.items():
+        losses = torch.zeros(eval_iters, device=device) # kept on the device, so the loop never waits on the GPU
+        for k in range(eval_iters):
+            X, Y = get_split_batch()
+            with autocast_ctx:
+                _, loss = model(X, Y)
+            #print("loss estimate_loss: " + str(loss)) # DEBUG.
+            losses[k] = loss.detach()
+            #print("k: " + str(k) + "; Estimate_loss: " + str(losses[k])) # Ted: DEBUG.
+        out[split] = losses.mean().item() # the only CPU-GPU sync point per split
+    model.train()
+    return out
+
+
+def checkpoint_to_cpu(obj, copies=None):
+    """Returns a copy of the checkpoint <obj> (nested dicts and lists) with every tensor copied to the CPU.
+    Needed before saving in the background, since the next training steps keep updating the live tensors.
+    Tensors viewing the same memory (the tied wte/lm_head weights) share one copy, so torch.save still writes it once.
+    """
+    if copies is None:
+        copies = {}
+    if torch.is_tensor(obj):
+        # state_dict() detaches every entry separately, so tied weights are distinct tensor objects over the same memory
+        key = (obj.device, obj.data_ptr(), obj.dtype, tuple(obj.shape), obj.stride())
+        if key not in copies:
+            copies[key] = obj.detach().to('cpu', copy=True)
+        return copies[key]
+    if isinstance(obj, dict):
+        return {k: checkpoint_to_cpu(v, copies) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [checkpoint_to_cpu(v, copies) for v in obj]
+    return obj
+
+
+def save_checkpoint(checkpoint, path):
+    """Saves <checkpoint> to a temporary file and renames it to <path>, so <path> is never left half written."""
+    tmp_path = path + '.tmp'
+    # the zipfile format is what mmap loading needs
+    torch.save(checkpoint, tmp_path, _use_new_zipfile_serialization=True) # Ted: ".pt" file is PyTorch's serialized file of a model object.
+    os.replace(tmp_path, path)
+
+
+# learning rate decay scheduler (cosine with warmup) # Ted: Dynamic learning rate IMO.
+def get_lr(it, learning_rate, warmup_iters, lr_decay_iters, min_lr):
+    # 1) linear warmup for warmup_iters steps
+    if it < warmup_iters:
+        return learning_rate * it / warmup_iters
+    # 2) if it > lr_decay_iters, return min learning rate
+    if it > lr_decay_iters:
+        return min_lr
+    # 3) in between, use cosine decay down to min learning rate
+    decay_ratio = (it - warmup_iters) / (lr_decay_iters - warmup_iters) # in [0, 1] given the two checks above
+    coeff = 0.5 * (1.0 + math.cos(math.pi * decay_ratio)) # coeff ranges 0..1
+    return min_lr + coeff * (learning_rate - min_lr)
+
+
+def train(config, start_from_scratch, GPTConfig, GPT, data_dtype, row_window, seq_len):
+    """Trains a model on the current configurations.
+    config: The dictionary of configurations.
+    start_from_scratch: If False, load a previous checkpoint. Otherwise, start from scratch.
+    GPTConfig, GPT: The model classes of the calling trainer.
+    data_dtype: The numpy dtype of the tokens in the ".bin" files.
+    row_window, seq_len: See <get_batch>.
+    output: The model (avoids needing to get the model from a file in Agent.py)
+    """
+    # keep the compiled kernels next to the checkpoints, so later runs of the same model find them on disk instead of
+    # compiling for a minute again. The environment variable is process-wide, so it is only set for this run
+    previous_cache_dir = os.environ.get('TORCHINDUCTOR_CACHE_DIR')
+    if _user_inductor_cache_dir is None and (config['compile'] or config['compile_optimizer']):
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(os.path.join(config['out_dir'], 'inductor_cache'))
+    try:
+        return _train(config, start_from_scratch, GPTConfig, GPT, data_dtype, row_window, seq_len)
+    finally:
+        if previous_cache_dir is None:
+            os.environ.pop('TORCHINDUCTOR_CACHE_DIR', None)
+        else:
+            os.environ['TORCHINDUCTOR_CACHE_DIR'] = previous_cache_dir
+
+
+def _train(config, start_from_scratch, GPTConfig, GPT, data_dtype, row_window, seq_len):
+    """<train> without setting up the inductor cache directory."""
+    # various inits, derived attributes, I/O setup
+    # We are running on a single gpu, and one process.
+    # simulate <simulated_nodes> gpus, each accumulating <gradient_accumulation_steps> micro steps. Scaling out to real
+    # gpus later only means splitting these micro steps across them: with the model wrapped in DDP each process runs
+    # gradient_accumulation_steps // world_size of them, and the micro step loop below skips the gradient sync on all
+    # but the last (model.no_sync(), or require_backward_grad_sync as in NanoGPT/train.py), so that backward
+    # all-reduces the accumulated .grad once per iteration
+    gradient_accumulation_steps = config['simulated_nodes'] * config['gradient_accumulation_steps']
+    os.makedirs(config['out_dir'], exist_ok=True)
+    torch.manual_seed(1337 + config['seed_offset'])
+    torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
+    torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+    torch.set_float32_matmul_precision('high') # let the remaining float32 matmuls use tf32 too
+
+    device_type = 'cuda' if 'cuda' in config['device'] else 'cpu' # for later use in torch.autocast
+    # note: float16 data type will automatically use a GradScaler
+    # note: 'auto' picks bfloat16 where the GPU supports it (Ampere and newer). It has the exponent range of float32,
+    # so unlike float16 it needs no loss scaling
+    dtype = config['dtype']
+    if dtype == 'auto':
+        dtype = 'float32' if device_type == 'cpu' else 'bfloat16' if torch.cuda.is_bf16_supported() else 'float16'
+    ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+    # one autocast object, entered only around the model forward. Disabled on the CPU, where it is a no-op like nullcontext()
+    autocast_ctx = torch.autocast(device_type=device_type, dtype=ptdtype, enabled=(device_type == 'cuda'))
+
+    # poor man's data loader
+    data_dir = os.path.join('data', config['dataset'])
+    # Training rows are streamed sequentially into RAM in the background, the small validation split stays a memmap.
+    train_data = RowPrefetcher(os.path.join(data_dir, 'train.bin'), data_dtype, config['num_tokens_row_train'],
+                               config['prefetch_chunk_mib'], config['prefetch_num_chunks'], 1337 + config['seed_offset'])
+    try:
+        val_data = open_rows(os.path.join(data_dir, 'val.bin'), data_dtype, config['num_tokens_row_train'])
+
+        # init these up here, can override if init_from_scratch is False (i.e. from a checkpoint)
+        iter_num = 0
+        best_val_loss = 1e9
+
+        # attempt to derive vocab_size from the dataset
+        meta_vocab_size = load_meta_vocab_size(data_dir)
+
+        # model init
+        model_args = dict(n_layer=config['n_layer'], n_head=config['n_head'], n_embd=config['n_embd'], block_size=config['block_size'],
+                        bias=config['bias'], vocab_size=None, dropout=config['dropout'])
+        print("model_args: " + str(model_args))
+        with torch.device(config['device']): # build the parameters directly on the device instead of copying them over afterwards
+            if start_from_scratch:
+                model = create_model_from_scratch(GPTConfig, GPT, model_args, meta_vocab_size) # Ted: Okay, if really want can control here for the vocab of model and adjust target vector accordingly.
+            else:
+                model, checkpoint, iter_num, best_val_loss = load_model(GPTConfig, GPT, model_args, config)
+        # crop down the model block size if desired, using model surgery
+        if config['block_size'] < model.config.block_size:
+            model.crop_block_size(config['block_size'])
+            model_args['block_size'] = config['block_size'] # so that the checkpoint will have the right value
+
+        # initialize a GradScaler, only float16 needs one. If enabled=False scaler is a no-op
+        use_scaler = ptdtype is torch.float16
+        scaler = torch.cuda.amp.GradScaler(enabled=use_scaler) # Ted: To prevent numerical instability.
+
+        # optimizer
+        optimizer = model.configure_optimizers(
+            config['weight_decay'], config['learning_rate'], (config['beta1'], config['beta2']), device_type
+        )
+        assert optimizer.defaults.get('fused') or optimizer.defaults.get('foreach'), "optimizer is not using the fused/foreach kernels"
+
+        if not start_from_scratch: # only now that the optimizer exists and holds the device parameters
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            for param_group in optimizer.param_groups:
+                # checkpoints written with the compiled step may hold the lr as a tensor, which the plain (non-capturable)
+                # foreach AdamW rejects. It is made a tensor again below if the step is compiled
+                if torch.is_tensor(param_group['lr']):
+                    param_group['lr'] = param_group['lr'].item()
+
+        if (config['compile'] or config['compile_optimizer']) and start_from_scratch:
+            torch._dynamo.reset() # drop graphs an earlier <train> in this process (e.g. from Agent.py) compiled
+
+        # compile the optimizer step so that the many small per-parameter update kernels are fused. The GradScaler has to
+        # skip steps with inf/nan gradients itself, so this is only done when it is disabled.
+        step_optimizer = None
+        if config['compile_optimizer'] and device_type == 'cuda' and not use_scaler:
+            for param_group in optimizer.param_groups:
+                # a tensor updated in place, since a new Python float every iteration would force a recompile
+                param_group['lr'] = torch.as_tensor(param_group['lr'], device=config['device'])
+
+            @torch.compile(fullgraph=False)
+            def step_optimizer():
+                optimizer.step()
+
+        # the uncompiled model, for the checkpoints (its state_dict keys have no '_orig_mod.' prefix) and estimate_mfu
+        raw_model = model
+        # compile the model, last, after all changes to it such as crop_block_size
+        if config['compile']:
+            print("compiling the model... (takes a ~minute)")
+            # batches are padded to one fixed shape (see <get_batch>), so 'reduce-overhead' can replay the whole
+            # forward/backward as CUDA graphs instead of launching every kernel from Python
+            model = torch.compile(model, mode=config['compile_mode'], fullgraph=True, dynamic=False) # requires PyTorch 2.0
+
+        # persistent staging buffers for batches on the GPU. Evaluation gets its own pair of slots so that it never
+        # overwrites the training batch that was prefetched before it.
+        train_buffers, eval_buffers = None, None
+        if device_type == 'cuda':
+            max_seq_len = config['num_tokens_row_train'] - 1 # x and y of a whole row.
+            # the narrowest signed type holding every token id (unsigned 16/32 bit tensors lack the ops for the copies)
+            token_dtype = torch.int16 if model_args['vocab_size'] <= 2**15 else torch.int32
+            train_buffers = BatchBuffers(config['device'], config['batch_size'], max_seq_len, token_dtype, seq_len)
+            eval_buffers = BatchBuffers(config['device'], config['batch_size'], max_seq_len, token_dtype, seq_len)
+
+        # bind the batch arguments once, so the training loop does no config lookups per micro step
+        grad_clip = config['grad_clip']
+        trainable_params = [p for p in model.parameters() if p.requires_grad] # Fixed list, not a new generator every step.
+        clip_foreach = device_type == 'cuda' # One multi-tensor norm kernel instead of one per parameter, CUDA only.
+        get_train_batch = functools.partial(get_batch, train_data, config['device'], config['num_tokens_row_train'], config['batch_size'], row_window, seq_len, train_buffers)
+        get_eval_batch = {split: functools.partial(get_batch, data, config['device'], config['num_tokens_row_train'], config['batch_size'], row_window, seq_len, eval_buffers)
+                          for split, data in [('train', train_data), ('val', val_data)]}
+
+        # training loop
+        X, Y = get_train_batch() # fetch the very first batch
+        if config['compile']:
+            # warm up on the first batch so compilation, autotuning and graph capture happen before the timed loop
+            for _ in range(3):
+                with autocast_ctx:
+                    _, loss = model(X, Y)
+                loss.backward()
+            optimizer.zero_grad(set_to_none=True) # the warm-up gradients are thrown away
+        start_iter_num = iter_num # first iteration in the lifetime of this process
+        t0, t0_iter_num = time.perf_counter(), iter_num # start of the current logging window and its first iteration
+        running_mfu = -1.0
+        last_lr = None # the learning rate currently set in the optimizer
+        # checkpoints are written by a background thread, one at a time, so saving does not stall training
+        checkpoint_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        checkpoint_future = None
+        for iter_num in range(start_iter_num, config['max_iters'] + 1):
+            #print("iter_num: " + str(iter_num)) # Ted: DEBUG.
+            # determine and set the learning rate for this iteration
+            lr = get_lr(
+                iter_num, config['learning_rate'], config['warmup_iters'], config['lr_decay_iters'], config['min_lr']
+            ) if config['decay_lr'] else config['learning_rate']
+            if lr != last_lr: # constant for long stretches, e.g. without decay_lr or once past lr_decay_iters
+                for param_group in optimizer.param_groups:
+                    if torch.is_tensor(param_group['lr']):
+                        param_group['lr'].fill_(lr)
+                    else:
+                        param_group['lr'] = lr
+                last_lr = lr
+            # evaluate the loss on train/val sets and write checkpoints
+            if iter_num % config['eval_interval'] == 0:
+                # evaluation and checkpointing are left out of the logged time per iteration. The training work queued
+                # so far still counts, so wait for it before reading the clock
+                if device_type == 'cuda':
+                    torch.cuda.synchronize()
+                t_eval = time.perf_counter()
+                #print("Here: before estimate_loss") # Ted: DEBUG.
+                losses = estimate_loss(model, autocast_ctx, config['eval_iters'], get_eval_batch, config['device'])
+                print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
+                if losses['val'] < best_val_loss or config['always_save_checkpoint']:
+                    best_val_loss = losses['val']
+                    if iter_num > 0:
+                        if checkpoint_future is not None:
+                            # only one save at a time. Waiting (instead of skipping) keeps <best_val_loss> equal to what is
+                            # on disk, and re-raises if the previous save failed
+                            checkpoint_future.result()
+                        optimizer_state = optimizer.state_dict()
+                        for param_group in optimizer_state['param_groups']:
+                            if torch.is_tensor(param_group['lr']): # saved as a float, see the compiled optimizer step
+                                param_group['lr'] = param_group['lr'].item()
+                        checkpoint = checkpoint_to_cpu({
+                            'model': raw_model.state_dict(),
+                            'optimizer': optimizer_state,
+                            'model_args': model_args,
+                            'iter_num': iter_num,
+                            'best_val_loss': best_val_loss,
+                            'config': OmegaConf.to_container(config, resolve=True), # a plain dict, so it loads with weights_only=True
+                        })
+                        print(f"saving checkpoint to {config['out_dir']}")
+                        checkpoint_future = checkpoint_executor.submit(save_checkpoint, checkpoint, os.path.join(config['out_dir'], 'ckpt.pt'))
+                t0 += time.perf_counter() - t_eval # shift the logging window past the evaluation
+            if iter_num == 0 and config['eval_only']:
+                break
+            # forward backward update, with optional gradient accumulation to simulate larger batch size
+            # and using the GradScaler if data type is float16. backward() already sums into each p.grad, so .grad is the
+            # accumulation buffer and no separate copy of the gradients is kept
+            for micro_step in range(gradient_accumulation_steps):
+                with autocast_ctx:
+                    logits, loss = model(X, Y)
+                loss = loss / gradient_accumulation_steps # scale the loss so the accumulated gradient is the mean over micro steps
+                #print("loss micro_step: " + str(loss)) # DEBUG.
+                # immediately async prefetch next batch while model is doing the forward pass on the GPU
+                X, Y = get_train_batch()
+                # backward pass, with gradient scaling if training in fp16
+                if use_scaler:
+                    scaler.scale(loss).backward()
+                else:
+                    loss.backward()
+
+            # clip the gradient
+            if grad_clip != 0.0:
+                if use_scaler:
+                    scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(trainable_params, grad_clip, foreach=clip_foreach)
+            # step the optimizer and scaler if training in fp16
+            if step_optimizer is not None:
+                step_optimizer()
+            elif use_scaler:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            # flush the gradients as soon as we can, no need for this memory anymore
+            optimizer.zero_grad(set_to_none=True)
+            # timing and logging. Only log iterations read the clock and wait for the GPU, the time per iteration is
+            # averaged over the whole window since the last one
+            if iter_num % config['log_interval'] == 0: # Ted: <log_interval> is e.g. print curr iteration report to command line.
+                if device_type == 'cuda':
+                    torch.cuda.synchronize() # so the window ends once its queued work actually finished
+                t1 = time.perf_counter()
+                dt = (t1 - t0) / (iter_num + 1 - t0_iter_num)
+                t0, t0_iter_num = t1, iter_num + 1
+                lossf = loss.item() * gradient_accumulation_steps # loss as float, undoing the division above
+                if iter_num - start_iter_num >= 5: # let the training loop settle a bit
+                    mfu = raw_model.estimate_mfu(config['batch_size'] * gradient_accumulation_steps, dt)
+                    running_mfu = mfu if running_mfu == -1.0 else 0.9*running_mfu + 0.1*mfu
+                print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, mfu {running_mfu*100:.2f}%")
+
+        checkpoint_executor.shutdown() # waits for the last checkpoint to be written
+        if checkpoint_future is not None:
+            checkpoint_future.result()
+        return model
+    finally:
+        train_data.close() # stop the prefetch thread however training ended
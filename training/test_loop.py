@@ -0,0 +1,41 @@
+import unittest
+
+import numpy as np
+import torch
+
+from training.loop import get_batch
+
+
+def cube_window(num_tokens_per_row):
+    return slice(4 * 29, num_tokens_per_row)
+
+
+class GetBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        # every token tells its row and column apart, rows[i, t] = i * 1000 + t
+        self.rows = (np.arange(50)[:, None] * 1000 + np.arange(319)[None, :]).astype(np.uint32)
+
+    def test_unpadded_batch_is_window_length(self):
+        x, y = get_batch(self.rows, 'cpu', 319, 8, cube_window, None)
+        window_len = 319 - 4 * 29
+        self.assertEqual(x.shape, (8, window_len - 1))
+        self.assertEqual(y.shape, (8, window_len - 1))
+        self.assertEqual(x.dtype, torch.int64)
+        ix = x[:, 0].numpy() // 1000
+        np.testing.assert_array_equal(x.numpy(), self.rows[ix, 4 * 29:-1])
+        np.testing.assert_array_equal(y.numpy(), self.rows[ix, 4 * 29 + 1:])
+
+    def test_padded_batch_is_seq_len(self):
+        x, y = get_batch(self.rows, 'cpu', 319, 8, cube_window, 318)
+        n = 319 - 4 * 29 - 1
+        self.assertEqual(x.shape, (8, 318))
+        ix = x[:, 0].numpy() // 1000
+        np.testing.assert_array_equal(x.numpy()[:, :n], self.rows[ix, 4 * 29:-1])
+        np.testing.assert_array_equal(y.numpy()[:, :n], self.rows[ix, 4 * 29 + 1:])
+        self.assertTrue((x[:, n:] == 0).all())
+        self.assertTrue((y[:, n:] == -1).all())
+
+
+if __name__ == '__main__':
+    unittest.main()